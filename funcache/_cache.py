@@ -1,6 +1,16 @@
-import collections
-from multiprocessing import Manager
-import time
+import collections.abc
+from threading import Condition
+from funcache._shared_memory import SharedMemoryResult, CacheManager
+import warnings
+import inspect
+import hashlib
+import pickle
+
+try:
+    from xxhash import xxh3_64_intdigest as _digest
+except ImportError:
+    def _digest(data):
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
 
 
 class Cache(object):
@@ -11,29 +21,39 @@ class Cache(object):
     # A dictionary : function_key -> callable
     _cached_functions = dict()
     # The cache, represented by a dictionary of the form function_key -> dict(args_key -> result)
+    # When multiprocessing is enabled, the functions entries are shared dictionaries
     _cache = dict()
     # A boolean specifying if the Cache was initialized or not
     _is_init = False
     # A boolean specifying if the Cache is active or not. True by default
     _is_active = True
+    # The types of arguments that are used as they are in the args keys
+    _atomic_args_types = frozenset([int, str, float, bytes, bool, type(None)])
 
     # Attributes used for multiprocessing
     # A manager for the sharable objects
     _manager = None
-    # Locks for securing accesses, a dictionary of the form function_key -> lock object
-    _locks = None
-    # A list of the running queries
-    _running_queries = list()
+    # A manager for the shared memory blocks holding the large binary results.
+    # In the main process, it's the manager of the sharable objects, the other processes connect to it
+    _shared_memory_manager = None
+    # The running queries, a dictionary of the form (function_key, args_key) -> True
+    _running_queries = dict()
+    # A condition notified whenever a running query is over
+    _running_queries_condition = Condition()
     # A boolean specifying whether multiprocessing is set or not
     _multiprocessing = False
+    # The results this process already retrieved from the shared cache, a dictionary of the form
+    # function_key -> dict(args_key -> result). It is only used with multiprocessing & never shared
+    _local_cache = dict()
 
-    def __init__(self, *args):
+    def __init__(self, hash_args=False, *args):
         """
         This constructor is meant to be used as a decorator
         Has to be redefined by subclasses to process eventual arguments
+        :param hash_args: Whether to use :func:~Cache.get_args_digest instead of :func:~Cache.get_args_key
         :param args:
         """
-        pass
+        self.hash_args = hash_args
 
     def __call__(self, original_function):
         """
@@ -45,10 +65,36 @@ class Cache(object):
         self.func_key = self.cache_function(original_function)
         if self.func_key is None:
             return self.original_function
-        temp_self = self
+        if self.hash_args:
+            self.get_args_key = self.get_args_digest
+        self._adapt_legacy_post_get()
+        # The attributes used by the wrapper are looked up once & for all here
+        # The cache itself is looked up at each call, as it is replaced at initialization & with multiprocessing
+        cls = type(self)
+        func_key = self.func_key
+        get_args_key = self.get_args_key
+        get_from_args_key = self._get_from_args_key
+        post_get = self.post_get
 
         def wrapper(*args):
-            return temp_self._get(*args)
+            if not cls._is_active:
+                return original_function(*args)
+            args_key = get_args_key(args)
+            try:
+                # Fast path for the results that are already in the cache
+                if cls._multiprocessing:
+                    result = cls._local_cache[func_key][args_key]
+                else:
+                    result = cls._cache[func_key][args_key]
+            except KeyError:
+                # The KeyError is also raised if the Cache is not initialized yet
+                if not cls._is_init:
+                    cls.init()
+                # It is also raised at the first use of the function
+                if func_key not in cls._cache:
+                    cls.init_function(func_key)
+                return get_from_args_key(args_key, *args)
+            return post_get(args_key, result, *args)
 
         self.post_wrap()
         return wrapper
@@ -63,15 +109,23 @@ class Cache(object):
     @classmethod
     def init(cls, *args):
         """
-        Initializes the cache by setting entries for the cached functions
+        Initializes the cache. The entries of the cached functions are only set at their first use,
+        by :func:~Cache.init_function
         If this method is not called explicitly by the user, The cache is automatically initialized at its first use
         :return:
         """
-        for cached_function in cls._cached_functions:
-            cls._cache[cached_function] = dict()
         cls.post_cache_init()
         cls._is_init = True
 
+    @classmethod
+    def init_function(cls, func_key):
+        """
+        Sets the entry of a cached function in the cache. It is called at the first use of the function
+        Meant to be redefined by subclasses that need other kinds of entries
+        :param func_key: The function's key
+        """
+        cls._cache[func_key] = dict()
+
     @classmethod
     def post_cache_init(cls):
         """
@@ -97,13 +151,81 @@ class Cache(object):
         """
         This method serves to convert the functions args to hashable objects (because lists are not hashable)
         We make sure to convert them to tuples, (& also their contents).
+        Scalars such as numbers & strings are kept as they are, without walking through them.
         :param args: an object representing the arguments to be passed to a function
         :return: The key corresponding to args in the cache
         """
-        if isinstance(args, collections.Iterable):
-            args = tuple([Cache.get_args_key(arg) for arg in args])
+        args_type = type(args)
+        atomic_args_types = Cache._atomic_args_types
+        if args_type in atomic_args_types:
+            return args
+        if args_type is tuple:
+            # Tuples of scalars, like most of the functions args, are already keys, so they are kept as they are
+            for arg in args:
+                if type(arg) not in atomic_args_types:
+                    break
+            else:
+                return args
+        # Strings are iterables of strings, so they are never walked through, even for subclasses of str
+        if isinstance(args, (str, bytes)):
+            return args
+        # bytearrays are not hashable
+        if isinstance(args, bytearray):
+            return bytes(args)
+        if args_type is tuple or isinstance(args, collections.abc.Iterable):
+            return tuple([Cache.get_args_key(arg) for arg in args])
         return args
 
+    @staticmethod
+    def get_args_digest(args):
+        """
+        An alternative to :func:~Cache.get_args_key for functions taking large structured arguments.
+        The key is a 64 bits integer computed from the pickled arguments, using xxhash if it is installed.
+        Arguments that are all scalars are kept as they are, so their keys are the same as with get_args_key.
+        Note that equal arguments that are pickled differently (like sets of strings in different runs) get different keys
+        :param args: an object representing the arguments to be passed to a function
+        :return: The key corresponding to args in the cache
+        """
+        atomic_args_types = Cache._atomic_args_types
+        if all(type(arg) in atomic_args_types for arg in args):
+            return args
+        return _digest(pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def load_shared_result(result):
+        """
+        Only meaningful when multiprocessing is enabled
+        :param result: A result retrieved from the shared cache
+        :return: The actual result, loaded from its shared memory block if it is stored in one
+        """
+        if type(result) is SharedMemoryResult:
+            try:
+                return result.load()
+            except FileNotFoundError:
+                # The result was removed from the shared cache meanwhile
+                raise KeyError(result.name)
+        return result
+
+    @classmethod
+    def release_shared_result(cls, result):
+        """
+        Only meaningful when multiprocessing is enabled.
+        Called when a result is removed from the shared cache, to free the shared memory block it may be stored in
+        :param result: The result removed from the shared cache
+        """
+        if type(result) is SharedMemoryResult:
+            result.release(cls._shared_memory_manager)
+
+    @staticmethod
+    def release_local_result(result):
+        """
+        Only meaningful when multiprocessing is enabled.
+        Called when a result is removed from the local cache, to detach this process from the shared memory block
+        the result may use
+        :param result: The result removed from the local cache
+        """
+        SharedMemoryResult.detach(result)
+
     @classmethod
     def activate(cls):
         """
@@ -133,45 +255,138 @@ class Cache(object):
         # Initialize the Cache if it's not already done
         if not self._is_init:
             self.init()
+        if self.func_key not in self._cache:
+            self.init_function(self.func_key)
         # Retrieve the key for the given arguments
-        args_key = self.get_args_key(args)
-        # Check if the same function for the same arguments is already being computed in another process
-        while (self.func_key, args_key) in self._running_queries:
-            time.sleep(0.01)
-        # Check if the function's result for the given args is already in the cache
-        if args_key not in self._cache[self.func_key].keys():
-            # If not, we will compute it, so we have to prevent other process from doing the same thing
-            self._running_queries.append((self.func_key, args_key))
-            # Compute the result with the original function
-            result = self.original_function(*args)
-            if self._multiprocessing:
-                # If we are using multiprocessing, we have to lock the access to the function's entry in the cache
-                self._locks[self.func_key].acquire()
-                # We also have to do a little trick to update the cache
-                entry = self._cache[self.func_key]
-                entry[args_key] = result
-                self._cache[self.func_key] = entry
-                # We release the lock
-                self._locks[self.func_key].release()
-            else:
-                # If we are not using multiprocessing, the update is straightforward
-                self._cache[self.func_key][args_key] = result
-            self._running_queries.remove((self.func_key, args_key))
-        else:
-            # If the result is already present, we just retrieve
+        return self._get_from_args_key(self.get_args_key(args), *args)
+
+    def _get_from_args_key(self, args_key, *args):
+        """
+        Does the work of :func:~Cache._get once the cache is known to be active & initialized
+        :param args_key: The key corresponding to args in the cache
+        :param args: The arguments to pass to the function
+        :return: The function's result for the given arguments
+        """
+        multiprocessing = self._multiprocessing
+        if multiprocessing:
+            local_cache = self._local_cache[self.func_key]
+            if args_key in local_cache:
+                # The result was already retrieved by this process, no need to access the shared cache
+                return self.post_get(args_key, local_cache[args_key], *args)
+            self.pre_shared_get(args_key)
+        try:
+            # If the result is already present, we just retrieve it
             result = self._cache[self.func_key][args_key]
-        self.post_get(result, *args)
+            if multiprocessing:
+                result = self.load_shared_result(result)
+        except KeyError:
+            result = self._compute(args_key, *args)
+        if multiprocessing:
+            local_cache[args_key] = result
+        return self.post_get(args_key, result, *args)
+
+    def _compute(self, args_key, *args):
+        """
+        Computes the function's result for the given args & stores it in the cache.
+        If the same result is being computed by another process, its computation is awaited instead
+        :param args_key: The key corresponding to args in the cache
+        :param args: The arguments to pass to the function
+        :return: The function's result for the given arguments
+        """
+        query_key = (self.func_key, args_key)
+        cache = self._cache[self.func_key]
+        with self._running_queries_condition:
+            # Wait if the same function for the same arguments is already being computed in another process
+            while query_key in self._running_queries:
+                self._running_queries_condition.wait()
+            try:
+                # The result may have been computed while waiting
+                result = cache[args_key]
+                if self._multiprocessing:
+                    result = self.load_shared_result(result)
+                is_computed = True
+            except KeyError:
+                # If not, we will compute it, so we have to prevent other process from doing the same thing
+                self._running_queries[query_key] = True
+                is_computed = False
+        if not is_computed:
+            try:
+                # Compute the result with the original function
+                result = self.original_function(*args)
+                self.pre_set(args_key, result)
+                if self._multiprocessing:
+                    # The function's entry is itself a shared dictionary, so it is updated in place by a single call.
+                    # No lock is needed, the running query ensures this process is the only one computing the result
+                    cache[args_key] = SharedMemoryResult.store(result, self._shared_memory_manager)
+                else:
+                    # If we are not using multiprocessing, the update is straightforward
+                    cache[args_key] = result
+                self.post_set(args_key, result)
+            finally:
+                # Wake up the processes waiting for this query, even if the function raised an exception
+                with self._running_queries_condition:
+                    self._running_queries.pop(query_key, None)
+                    self._running_queries_condition.notify_all()
         return result
 
-    def post_get(self, result, *args):
+    def pre_shared_get(self, args_key):
+        """
+        This method is meant to be implemented by subclasses.
+        With multiprocessing, it is called before a result that is not in the local cache is looked up in the shared one
+        :param args_key: The key corresponding to the args in the cache
+        """
+        pass
+
+    def pre_set(self, args_key, result):
+        """
+        This method is meant to be implemented by subclasses.
+        It is called after a result is computed, before it is stored in the cache & visible to the other processes
+        :param args_key: The key corresponding to the args in the cache
+        :param result: The computed result
+        """
+        pass
+
+    def post_set(self, args_key, result):
+        """
+        This method is meant to be implemented by subclasses.
+        It is called after a computed result is stored in the cache, before the processes waiting for it are notified
+        :param args_key: The key corresponding to the args in the cache
+        :param result: The computed result
+        """
+        pass
+
+    def post_get(self, args_key, result, *args):
         """
         This method is meant to be implemented by subclasses.
         It is called after the cache is accessed.
         Note that this method is not called if the cache is not active
+        :param args_key: The key corresponding to the args in the cache
         :param result: The result retrieved by the cache
         :param args: The args that were passed to the function
+        :return: The result to return to the caller
         """
-        pass
+        return result
+
+    def _adapt_legacy_post_get(self):
+        """
+        Before receiving the args key & returning the result, post_get was called as post_get(result, *args)
+        & its return value was ignored. The overrides still having this signature are deprecated,
+        they are adapted to the current one, so that they keep working
+        """
+        parameters = inspect.signature(self.post_get).parameters.values()
+        positional_parameters = [parameter for parameter in parameters
+                                 if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD)]
+        if len(positional_parameters) != 1:
+            return
+        warnings.warn(type(self).__name__ + ".post_get(result, *args) is deprecated, "
+                      "post_get now receives the args key first & returns the result: "
+                      "post_get(args_key, result, *args)", DeprecationWarning, stacklevel=3)
+        legacy_post_get = self.post_get
+
+        def post_get(args_key, result, *args):
+            legacy_post_get(result, *args)
+            return result
+        self.post_get = post_get
 
     @classmethod
     def enable_multiprocessing(cls, pool, pool_size):
@@ -181,22 +396,38 @@ class Cache(object):
         Which could slower the access
         :param pool: The pool of processes for which we enable the Cache
         :type pool: multiprocessing.Pool
-        :param pool_size: The size of the pool
+        :param pool_size: The size of the pool. It must be the pool's number of processes,
+                          as each of them waits for all the others to receive the shared objects
         """
+        # A wrong size would block the processes forever. The pool doesn't expose its processes publicly,
+        # they are counted through its private list of workers
+        if pool_size != len(pool._pool):
+            raise ValueError("pool_size is " + str(pool_size) + " but the pool has " + str(len(pool._pool)) +
+                             " processes")
         if not cls._is_init:
             cls.init()
-        cls._multiprocessing = True
-        cls._manager = Manager()
-        cls._cache = cls._manager.dict(cls._cache)
-        cls._locks = dict()
+        # The processes share the entries of all the cached functions, so they all have to be set
         for cached_function in cls._cached_functions:
-            cls._locks[cached_function] = cls._manager.Lock()
-        cls._running_queries = cls._manager.list(cls._running_queries)
+            if cached_function not in cls._cache:
+                cls.init_function(cached_function)
+        cls._multiprocessing = True
+        cls._manager = CacheManager()
+        cls._manager.start()
+        # The manager of the sharable objects also tracks the shared memory blocks
+        cls._shared_memory_manager = cls._manager
+        # The set of cached functions doesn't change anymore, so only their entries need to be shared dictionaries
+        cls._cache = {cached_function: cls._manager.dict(cls._cache[cached_function])
+                      for cached_function in cls._cached_functions}
+        cls._running_queries = cls._manager.dict(cls._running_queries)
+        cls._running_queries_condition = cls._manager.Condition()
+        cls._local_cache = {cached_function: dict() for cached_function in cls._cached_functions}
         # Send the shared objects to the processes
         cls.pre_share_context()
-        context = [cls._is_active, cls._cache, cls._locks, cls._running_queries]
+        context = [cls._is_active, cls._cache, cls._running_queries, cls._running_queries_condition,
+                   cls._shared_memory_manager.address]
         context.extend(cls.build_context())
-        pool.starmap(cls.post_spawn, [tuple(context)] * pool_size)
+        barrier = cls._manager.Barrier(pool_size)
+        pool.starmap(cls._synchronized_post_spawn, [(barrier, *context)] * pool_size)
 
     @classmethod
     def pre_share_context(cls):
@@ -228,21 +459,37 @@ class Cache(object):
         pass
 
     @classmethod
-    def post_spawn(cls, is_active, cache, locks, running_queries, *args):
+    def _synchronized_post_spawn(cls, barrier, *context):
+        """
+        Calls :func:~Cache.post_spawn, then waits for all the processes of the pool to do the same.
+        This way, a process can't receive the context twice while another one doesn't receive it
+        :param barrier: A barrier for the size of the pool
+        :param context: The shared cache objects
+        """
+        cls.post_spawn(*context)
+        barrier.wait()
+
+    @classmethod
+    def post_spawn(cls, is_active, cache, running_queries, running_queries_condition,
+                   shared_memory_manager_address, *args):
         """
         This method receives the shared cache objects from the main process
         :param is_active: The activity/inactivity of the Cache
         :param cache: The cache
-        :param locks: The locks
         :param running_queries: The running queries
+        :param running_queries_condition: The condition notified when a running query is over
+        :param shared_memory_manager_address: The address of the manager of the shared memory blocks
         :param args: Other objects that may have been added by subclasses
         """
         cls._is_init = True
         cls._multiprocessing = True
         cls._is_active = is_active
         cls._cache = cache
-        cls._locks = locks
         cls._running_queries = running_queries
+        cls._running_queries_condition = running_queries_condition
+        cls._local_cache = {cached_function: dict() for cached_function in cls._cached_functions}
+        cls._shared_memory_manager = CacheManager(address=shared_memory_manager_address)
+        cls._shared_memory_manager.connect()
         cls._receive_context(*args)
 
 
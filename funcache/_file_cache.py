@@ -1,12 +1,21 @@
 from funcache._cache import Cache
-import pickle
+from threading import Condition
+from itertools import islice
+import warnings
 import atexit
+import pickle
+import time
+import os
 
 
 class FileCache(Cache):
     """
     This classed provides functions results file caching functionality.
     It's simple to use as you just have to decorate your function with *@FileCache(cache_file="cache_file.pkl")
+    The cache files are append-only logs : they start with a snapshot, which is a tuple (results, timestamps)
+    of dictionaries indexed by the args keys, followed by a record (args_key, result, timestamp) for each result
+    computed since then, the timestamps being the times at which the results were computed.
+    The logs are compacted to a single snapshot when they are loaded, if they contain too many outdated records
     """
     # These attributes are redefined here to prevent having the same values of the class variables of the Base class
     # (& so the siblings)
@@ -20,30 +29,48 @@ class FileCache(Cache):
     _default_cache_files_extension = ".pkl"
     _cache_files = dict()
     _at_exit_set = False
+    # The times at which the results were computed, a dictionary of the form function_key -> dict(args_key -> time)
+    _timestamps = dict()
+    # The timestamps of the results in the local cache of this process, only used with multiprocessing
+    _local_timestamps = dict()
+    # The time to live & maximum number of results of each function, a None value meaning no limit
+    _ttls = dict()
+    _max_sizes = dict()
     # Attributes used for multiprocessing
     _manager = None
-    _locks = None
-    _running_queries = list()
+    _running_queries = dict()
+    _running_queries_condition = Condition()
     _multiprocessing = False
+    _local_cache = dict()
 
-    def __init__(self, cache_file=None, *args):
+    def __init__(self, cache_file=None, ttl=None, max_size=None, hash_args=False, *args):
         """
         Meant to be used as a decorator.
         Enables to cache a function's results in a file
         :param cache_file: The file to be used as a cache.
                             By default, the file path is deduced from the function's qualname & the default cache root
                             & cache files extension
+        :param ttl: The time to live of the results, in seconds. When it is exceeded, the result is computed again.
+                    By default, the results never expire
+        :param max_size: The maximum number of results to store.
+                         When it is exceeded, the least recently computed results are removed. By default, no limit
+        :param hash_args: Whether to identify the arguments by a digest of their pickled form.
+                          Useful for functions taking large structured arguments
         :param args: Just here to ensure possible extensions in sub classes
         """
-        super(FileCache, self).__init__(*args)
+        super(FileCache, self).__init__(hash_args, *args)
         self.cache_file = cache_file
+        self.ttl = ttl
+        self.max_size = max_size
 
     def post_wrap(self):
         """
-        Stores the cache file path
+        Stores the cache file path, the time to live & the maximum size of the function's cache
         :return:
         """
         self._cache_files[self.func_key] = self.cache_file
+        self._ttls[self.func_key] = self.ttl
+        self._max_sizes[self.func_key] = self.max_size
 
     @classmethod
     def init(cls, default_cache_root="resources/database/", default_cache_files_extension=".pkl"):
@@ -57,44 +84,271 @@ class FileCache(Cache):
         cls._is_init = True
         cls._default_cache_root = default_cache_root
         cls._default_cache_files_extension = default_cache_files_extension
-        cls.set_at_exit()
-        for cached_function in cls._cached_functions:
-            if cls._cache_files[cached_function] is None:
-                cls._cache_files[cached_function] = cls.get_default_cache_file_path(cached_function)
-            cache_file_path = cls._cache_files[cached_function]
+
+    @classmethod
+    def init_function(cls, func_key):
+        """
+        Called at the first use of a function.
+        Loads its cache file, so that only the files of the functions that are used are read
+        :param func_key: The function's key
+        """
+        if cls._cache_files[func_key] is None:
+            cls._cache_files[func_key] = cls.get_default_cache_file_path(func_key)
+        cache_file_path = cls._cache_files[func_key]
+        results, timestamps, records_count = cls.read_cache_file(cache_file_path)
+        results, timestamps = cls.drop_outdated(func_key, results, timestamps)
+        try:
+            # The results are appended to the file as soon as they are computed, so its folder has to exist
+            os.makedirs(os.path.dirname(cache_file_path) or ".", exist_ok=True)
+            # Compact the log when most of its records are outdated
+            if records_count >= 2 * len(results) and records_count > 0:
+                cls.write_cache_file(cache_file_path, results, timestamps)
+        except OSError as error:
+            # The results are still cached in memory, the file is only needed by the next runs
+            warnings.warn("Could not write the cache file " + cache_file_path + ": " + str(error))
+        # The entry in the cache is set last, as it marks the function as initialized
+        cls._timestamps[func_key] = timestamps
+        cls._cache[func_key] = results
+
+    @staticmethod
+    def read_cache_file(cache_file_path):
+        """
+        Reads the content of a cache file.
+        The cache files written before the timestamps were introduced only contain the results,
+        these are considered to be computed when they are read.
+        A truncated last record, left by a program that was interrupted while writing it, is removed from the file
+        :param cache_file_path: The path of the cache file
+        :return: The results & timestamps stored in the file, & the number of records they were read from
+        """
+        results, timestamps = dict(), dict()
+        records_count = 0
+        try:
+            with open(cache_file_path, "rb") as f:
+                while True:
+                    records_end = f.tell()
+                    try:
+                        record = pickle.load(f)
+                    except EOFError:
+                        # Either the end of the file, or a record truncated right at its beginning
+                        break
+                    except pickle.UnpicklingError as error:
+                        if "truncated" not in str(error):
+                            # The file is damaged, it is left as it is & the results read so far are kept
+                            warnings.warn("Could not read the cache file " + cache_file_path + " entirely: " +
+                                          str(error))
+                            records_end = None
+                        break
+                    if isinstance(record, dict):
+                        # An old cache file, containing only the results
+                        now = time.time()
+                        results, timestamps = record, {args_key: now for args_key in record}
+                        records_count += len(results)
+                    elif len(record) == 2:
+                        results, timestamps = record
+                        records_count += len(results)
+                    else:
+                        args_key, result, timestamp = record
+                        # The results computed again are moved to the end, to keep the timestamps ordered
+                        results.pop(args_key, None)
+                        timestamps.pop(args_key, None)
+                        results[args_key] = result
+                        timestamps[args_key] = timestamp
+                        records_count += 1
+                is_truncated = records_end is not None and records_end < os.fstat(f.fileno()).st_size
+        except FileNotFoundError:
+            # If the file doesn't exist, we initialize empty dictionaries for it
+            return results, timestamps, records_count
+        if is_truncated:
+            # The file is only opened for writing when needed, so that read only cache files can still be loaded
             try:
-                with open(cache_file_path, "rb") as f:
-                    cls._cache[cached_function] = pickle.load(f)
-                    f.close()
-            except FileNotFoundError:
-                # If the file doesn't exist, we initialize an empty dictionary for it
-                cls._cache[cached_function] = dict()
+                with open(cache_file_path, "rb+") as f:
+                    # So that the next records are appended after the valid ones
+                    f.truncate(records_end)
+            except OSError as error:
+                warnings.warn("Could not remove the truncated record of the cache file " + cache_file_path + ": " +
+                              str(error))
+        return results, timestamps, records_count
+
+    @staticmethod
+    def write_cache_file(cache_file_path, results, timestamps):
+        """
+        Replaces a cache file by a snapshot of the given results.
+        The snapshot is written to a temporary file first, so that the cache file is never left half written
+        :param cache_file_path: The path of the cache file
+        :param results: The results, a local dictionary
+        :param timestamps: The times at which the results were computed, a local dictionary
+        """
+        temporary_file_path = cache_file_path + ".tmp"
+        with open(temporary_file_path, "wb") as f:
+            pickle.dump((results, timestamps), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file_path, cache_file_path)
+
+    @classmethod
+    def drop_outdated(cls, func_key, results, timestamps):
+        """
+        Removes the expired results & the least recently computed ones exceeding the maximum size of the function's cache
+        :param func_key: The function's key
+        :param results: The function's results, a local dictionary
+        :param timestamps: The times at which the results were computed, a local dictionary
+        :return: The remaining results & timestamps
+        """
+        ttl = cls._ttls.get(func_key)
+        max_size = cls._max_sizes.get(func_key)
+        if ttl is None and max_size is None:
+            return results, timestamps
+        kept = sorted(timestamps, key=timestamps.get)
+        if ttl is not None:
+            now = time.time()
+            kept = [args_key for args_key in kept if now - timestamps[args_key] <= ttl]
+        if max_size is not None:
+            kept = kept[max(len(kept) - max_size, 0):]
+        return {args_key: results[args_key] for args_key in kept}, \
+               {args_key: timestamps[args_key] for args_key in kept}
+
+    def pre_set(self, args_key, result):
+        """
+        Called before a computed result is stored in the cache.
+        Records the time at which the result was computed. It is recorded first, as a result without timestamp
+        is considered to be removed by another process
+        :param args_key: The key corresponding to the args in the cache
+        :param result: The computed result
+        """
+        self._timestamps[self.func_key][args_key] = time.time()
+
+    def post_set(self, args_key, result):
+        """
+        Called after a computed result is stored in the cache.
+        Appends the result to the cache file & ensures the cache size does not exceed its limit
+        :param args_key: The key corresponding to the args in the cache
+        :param result: The computed result
+        """
+        timestamps = self._timestamps[self.func_key]
+        timestamp = timestamps.get(args_key)
+        if timestamp is None:
+            # The result was already removed by another process
+            return
+        # The record is written at once, so that the records appended concurrently by other processes are not mixed
+        record = pickle.dumps((args_key, result, timestamp), protocol=pickle.HIGHEST_PROTOCOL)
+        cache_file_path = self._cache_files[self.func_key]
+        try:
+            with open(cache_file_path, "ab") as f:
+                f.write(record)
+        except OSError as error:
+            # Failing to save the result must not fail the call, the result is still cached in memory
+            warnings.warn("Could not write the cache file " + cache_file_path + ": " + str(error))
+        if self.max_size is not None:
+            # The timestamps are inserted in the order the results are computed
+            excess = len(timestamps) - self.max_size
+            if excess > 0:
+                for key in list(islice(timestamps.keys(), excess)):
+                    self.forget(self.func_key, key)
+
+    def pre_shared_get(self, args_key):
+        """
+        Called with multiprocessing before a result is looked up in the shared cache.
+        Records the result's timestamp first, so that it can't be more recent than the result that is then retrieved
+        :param args_key: The key corresponding to the args in the cache
+        """
+        if self.ttl is not None:
+            timestamp = self._timestamps[self.func_key].get(args_key)
+            if timestamp is not None:
+                self._local_timestamps[self.func_key][args_key] = timestamp
+
+    def post_get(self, args_key, result, *args):
+        """
+        Called after the cache is accessed.
+        Computes the result again if it has expired.
+        With multiprocessing, also ensures the local cache of the process does not exceed the maximum size,
+        as the results evicted by the other processes are only removed from the shared one
+        :param args_key: The key corresponding to the args in the cache
+        :param result: The result that was retrieved from the cache
+        :param args: The arguments that were passed to the function
+        :return: The result to return to the caller
+        """
+        if self._multiprocessing and self.max_size is not None:
+            # The local caches are dictionaries, an entry is moved to their end by reinserting it
+            local_cache = self._local_cache[self.func_key]
+            local_cache[args_key] = local_cache.pop(args_key, result)
+            while len(local_cache) > self.max_size:
+                key = next(iter(local_cache))
+                self.release_local_result(local_cache.pop(key))
+                self._local_timestamps[self.func_key].pop(key, None)
+        if self.ttl is None:
+            return result
+        if not self._multiprocessing:
+            timestamp = self._timestamps[self.func_key].get(args_key)
+            if timestamp is not None and time.time() - timestamp > self.ttl:
+                self.forget(self.func_key, args_key)
+                result = self._compute(args_key, *args)
+            return result
+        # The result may come from the local cache, so its timestamp is the one recorded when it was retrieved,
+        # even if another process computed it again since then
+        local_timestamps = self._local_timestamps[self.func_key]
+        timestamp = local_timestamps.get(args_key)
+        if timestamp is None:
+            timestamp = self._timestamps[self.func_key].get(args_key)
+            if timestamp is not None:
+                local_timestamps[args_key] = timestamp
+        # A missing timestamp means the result was removed by another process while it was being retrieved
+        if timestamp is None or time.time() - timestamp > self.ttl:
+            self.release_local_result(self._local_cache[self.func_key].pop(args_key, None))
+            local_timestamps.pop(args_key, None)
+            # Another process may have already computed the result again
+            timestamp = self._timestamps[self.func_key].get(args_key)
+            try:
+                if timestamp is None or time.time() - timestamp > self.ttl:
+                    raise KeyError(args_key)
+                result = self.load_shared_result(self._cache[self.func_key][args_key])
+            except KeyError:
+                self.forget(self.func_key, args_key)
+                result = self._compute(args_key, *args)
+        return result
+
+    @classmethod
+    def forget(cls, func_key, args_key):
+        """
+        Removes a result from the cache, if it is present
+        :param func_key: The function's key
+        :param args_key: The key corresponding to the args in the cache
+        """
+        result = cls._cache[func_key].pop(args_key, None)
+        cls._timestamps[func_key].pop(args_key, None)
+        if cls._multiprocessing:
+            cls.release_shared_result(result)
+            cls.release_local_result(cls._local_cache[func_key].pop(args_key, None))
+            cls._local_timestamps[func_key].pop(args_key, None)
 
     @classmethod
     def pre_share_context(cls):
         """
-        Transform the cache files paths dictionary to another one that is shareable across processes
+        Transform the cache files paths & timestamps dictionaries to ones that are shareable across processes
         :return:
         """
         cls._cache_files = cls._manager.dict(cls._cache_files)
+        cls._timestamps = {cached_function: cls._manager.dict(cls._timestamps[cached_function])
+                           for cached_function in cls._cached_functions}
+        cls._local_timestamps = {cached_function: dict() for cached_function in cls._cached_functions}
 
     @classmethod
     def build_context(cls):
         """
-        Adds the cache files paths dictionary to the context to share among other processes
+        Adds the cache files paths & timestamps dictionaries to the context to share among other processes
         :return:
         """
-        return [cls._cache_files]
+        return [cls._cache_files, cls._timestamps]
 
     @classmethod
-    def _receive_context(cls, cache_files, *args):
+    def _receive_context(cls, cache_files, timestamps, *args):
         """
-        Handles the context reception (which consists of the cache files paths
+        Handles the context reception (which consists of the cache files paths & the timestamps)
         :param cache_files: The cache files paths
+        :param timestamps: The times at which the results were computed
         :param args: Just to ensure compatibility with possible subclasses
         :return:
         """
         cls._cache_files = cache_files
+        cls._timestamps = timestamps
+        cls._local_timestamps = {cached_function: dict() for cached_function in cls._cached_functions}
 
     @classmethod
     def get_default_cache_file_path(cls, func_key):
@@ -105,38 +359,36 @@ class FileCache(Cache):
         """
         return cls._default_cache_root + func_key + cls._default_cache_files_extension
 
+    @classmethod
+    def compact_files(cls):
+        """
+        Compacts the cache files, by replacing each of them by a snapshot of the results it contains.
+        The cache files are already compacted when they are loaded if needed, so calling this method is optional
+        """
+        for cached_function in cls._cache.keys():
+            cache_file_path = cls._cache_files[cached_function]
+            results, timestamps, records_count = cls.read_cache_file(cache_file_path)
+            if records_count > 0:
+                results, timestamps = cls.drop_outdated(cached_function, results, timestamps)
+                cls.write_cache_file(cache_file_path, results, timestamps)
+
     @classmethod
     def set_at_exit(cls):
         """
-        Sets the handler to save the cache files when the program ends
+        Deprecated, the results are saved in the cache files as soon as they are computed.
+        Sets the handler to compact the cache files when the program ends
         """
+        warnings.warn("FileCache.set_at_exit is deprecated, the results are saved as soon as they are computed",
+                      DeprecationWarning, stacklevel=2)
         if not cls._at_exit_set:
             cls._at_exit_set = True
-            atexit.register(cls.save_files)
+            atexit.register(cls.compact_files)
 
     @classmethod
     def save_files(cls):
         """
-        Called when the program ends. Saves the cache files
+        Deprecated alias of :func:~FileCache.compact_files, the results are saved as soon as they are computed
         """
-        for cached_function in cls._cache.keys():
-            try:
-                f = open(cls._cache_files[cached_function], "rb+")
-                changed = pickle.load(f)
-                if changed is not None and isinstance(changed, dict):
-                    for key in changed:
-                        if key not in cls._cache[cached_function]:
-                            if cls._multiprocessing:
-                                cls._locks[cached_function].acquire()
-                                entry = cls._cache[cached_function]
-                                entry[key] = changed[key]
-                                cls._cache[cached_function] = entry
-                                cls._locks[cached_function].release()
-                            else:
-                                cls._cache[cached_function][key] = changed[key]
-                f.close()
-            except FileNotFoundError:
-                pass
-            f = open(cls._cache_files[cached_function], "wb")
-            pickle.dump(cls._cache[cached_function], f)
-            f.close()
+        warnings.warn("FileCache.save_files is deprecated, use FileCache.compact_files instead",
+                      DeprecationWarning, stacklevel=2)
+        cls.compact_files()
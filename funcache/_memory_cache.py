@@ -1,4 +1,6 @@
 from funcache._cache import Cache
+from threading import Condition
+from collections import OrderedDict
 
 
 class MemoryCache(Cache):
@@ -13,82 +15,74 @@ class MemoryCache(Cache):
     _is_init = False
     # A boolean specifying if the Cache is active or not. True by default
     _is_active = True
-    # Unique to the memory cache
-    _accesses = dict()
     # Attributes used for multiprocessing
     _manager = None
-    _locks = None
-    _running_queries = list()
+    _running_queries = dict()
+    _running_queries_condition = Condition()
     _multiprocessing = False
+    _local_cache = dict()
 
-    def __init__(self, cache_size=1000, *args):
+    def __init__(self, cache_size=1000, hash_args=False, *args):
         """
         Meant to be used as a decorator.
         Enables to cache a function's results in a file
         :param cache_size: The maximum size of the memory cache. ie, the number of results to store
                             When the capacity is exceeded, the  result with the least recent access is removed
+        :param hash_args: Whether to identify the arguments by a digest of their pickled form.
+                          Useful for functions taking large structured arguments
         :param args: Just here to ensure possible extensions in sub classes
         """
-        super(MemoryCache).__init__(*args)
+        super(MemoryCache, self).__init__(hash_args, *args)
         self.cache_size = cache_size
 
     @classmethod
-    def post_cache_init(cls):
+    def init_function(cls, func_key):
         """
-        Called after the memory caching service is initialized.
-        Initializes the lists of accesses to each cache
+        Called at the first use of a function.
+        Its cache is an ordered one, the order of its entries being the order of the accesses to them
+        :param func_key: The function's key
         """
-        for cached_function in cls._cached_functions:
-            MemoryCache._accesses[cached_function] = list()
+        cls._cache[func_key] = OrderedDict()
 
-    def post_get(self, result, *args):
+    def post_set(self, args_key, result):
+        """
+        Called after a computed result is stored in the cache.
+        Ensures the cache size does not exceed its limit by removing the oldest results
+        :param args_key: The key corresponding to the args in the cache
+        :param result: The computed result
+        """
+        cache = self._cache[self.func_key]
+        if self._multiprocessing:
+            # The oldest entries may be evicted concurrently by other processes,
+            # hence the tolerance to already removed entries
+            excess = len(cache) - self.cache_size
+            if excess > 0:
+                for key in cache.keys()[:excess]:
+                    self.release_shared_result(cache.pop(key, None))
+        else:
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+    def post_get(self, args_key, result, *args):
         """
         Called after the cache is accessed.
-        To ensure the cache sizes do not exceed their limits
+        Marks the entry as the most recently accessed one.
+        With multiprocessing, this is done on the local cache of the process, to avoid accessing the shared one,
+        so its size is also checked here
+        :param args_key: The key corresponding to the args in the cache
         :param result: The result that was retrieved from the cache
         :param args: The arguments that were passed to the function
         """
-        args_key = self.get_args_key(args)
         if self._multiprocessing:
-            self._locks[self.func_key].acquire()
-            accesses = self._accesses[self.func_key]
-            if args_key in accesses:
-                accesses.remove(args_key)
-            accesses.append(args_key)
-            if len(accesses) > self.cache_size:
-                cache = self._cache[self.func_key]
-                to_delete = accesses[0]
-                if (self.func_key, to_delete) not in self._running_queries:
-                    accesses.pop(0)
-                    del cache[to_delete]
-                    self._cache[self.func_key] = cache
-            self._accesses[self.func_key] = accesses
-            self._locks[self.func_key].release()
+            # The local caches are dictionaries, an entry is moved to their end by reinserting it
+            local_cache = self._local_cache[self.func_key]
+            local_cache[args_key] = local_cache.pop(args_key, result)
+            while len(local_cache) > self.cache_size:
+                self.release_local_result(local_cache.pop(next(iter(local_cache))))
         else:
-            if len(self._accesses[self.func_key]) > self.cache_size:
-                del self._cache[self.func_key][self._accesses[self.func_key].pop(0)]
+            try:
+                self._cache[self.func_key].move_to_end(args_key)
+            except KeyError:
+                # The result was evicted as soon as it was computed, which only happens with a cache size of 0
+                pass
         return result
-
-    @classmethod
-    def pre_share_context(cls):
-        """
-        Converts the accesses lists to ones that are shareable across process
-        """
-        cls._accesses = cls._manager.dict(cls._accesses)
-
-    @classmethod
-    def build_context(cls):
-        """
-        Adds the list of accesses to the context to share among processes
-        :return: The context to share among processes
-        """
-        return [cls._accesses]
-
-    @classmethod
-    def _receive_context(cls, accesses, *args):
-        """
-        Handles the context reception
-        :param accesses: The accesses to the caches
-        :param args: Just to ensure compatibility with possible sub classes
-        """
-        cls._accesses = accesses
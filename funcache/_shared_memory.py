@@ -0,0 +1,140 @@
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.managers import SharedMemoryManager, SyncManager, dispatch
+from multiprocessing import resource_tracker
+import sys
+
+
+class SharedMemoryResult(object):
+    """
+    This class describes a result that is stored in a shared memory block rather than in the shared cache.
+    With multiprocessing, the large binary results (bytes, bytearrays & numpy arrays) are stored this way,
+    so that they are not pickled & sent through the manager at each access
+    """
+    # The minimal size in bytes of the results to store in shared memory blocks
+    threshold = 1 << 16
+    # The blocks this process is attached to, a dictionary of the form name -> SharedMemory
+    # Only the blocks of numpy arrays are kept open, because the arrays loaded from them use their memory directly
+    _attached_blocks = dict()
+
+    def __init__(self, name, size, result_type, dtype=None, shape=None):
+        """
+        :param name: The name of the shared memory block
+        :param size: The size of the result in bytes, the block may be larger
+        :param result_type: The type of the result
+        :param dtype: The dtype of the result if it is a numpy array
+        :param shape: The shape of the result if it is a numpy array
+        """
+        self.name = name
+        self.size = size
+        self.result_type = result_type
+        self.dtype = dtype
+        self.shape = shape
+
+    @classmethod
+    def store(cls, result, shared_memory_manager):
+        """
+        Stores a result in a shared memory block if it is a large binary one
+        :param result: The result to store
+        :param shared_memory_manager: The manager tracking the shared memory blocks
+        :type shared_memory_manager: multiprocessing.managers.SharedMemoryManager
+        :return: The description of the stored result, or the result itself if it isn't worth storing this way
+        """
+        result_type = type(result)
+        dtype = shape = None
+        if result_type is bytes or result_type is bytearray:
+            data = memoryview(result)
+        else:
+            # numpy is not imported here, if the result is a numpy array, it is already imported by the function
+            numpy = sys.modules.get("numpy")
+            if numpy is None or result_type is not numpy.ndarray or result.dtype.hasobject:
+                return result
+            result = numpy.ascontiguousarray(result)
+            dtype, shape = result.dtype, result.shape
+            data = memoryview(result).cast("B")
+        if data.nbytes < cls.threshold:
+            return result
+        block = shared_memory_manager.SharedMemory(size=data.nbytes)
+        cls._untrack(block)
+        block.buf[:data.nbytes] = data
+        block.close()
+        return cls(block.name, data.nbytes, result_type, dtype, shape)
+
+    def load(self):
+        """
+        Raises a FileNotFoundError if the block was released meanwhile
+        :return: The result stored in the shared memory block.
+                 numpy arrays are loaded without copy, so they are made read only
+        """
+        if self.shape is None:
+            # The other results are copied, so the block is closed right away
+            block = SharedMemory(name=self.name)
+            self._untrack(block)
+            result = self.result_type(block.buf[:self.size])
+            block.close()
+            return result
+        block = self._attached_blocks.get(self.name)
+        if block is None:
+            block = SharedMemory(name=self.name)
+            self._untrack(block)
+            self._attached_blocks[self.name] = block
+        import numpy
+        result = numpy.ndarray(self.shape, dtype=self.dtype, buffer=block.buf)
+        result.flags.writeable = False
+        return result
+
+    def release(self, shared_memory_manager):
+        """
+        Unlinks the shared memory block, it is called when the result is removed from the shared cache.
+        Its memory is freed once the processes attached to it are detached
+        :param shared_memory_manager: The manager tracking the shared memory blocks
+        :type shared_memory_manager: CacheManager
+        """
+        shared_memory_manager.release_segment(self.name)
+
+    @classmethod
+    def detach(cls, result):
+        """
+        Called when a result loaded by this process is dropped.
+        Closes the blocks whose arrays are not used anymore. An array, & its views, reference the buffer of its block,
+        so a block is unused once its buffer is only referenced by the block itself.
+        The arrays still used by the caller are checked again by the next calls
+        :param result: The dropped result
+        """
+        del result
+        for name, block in list(cls._attached_blocks.items()):
+            # The references of the block & of getrefcount's argument
+            if sys.getrefcount(block.buf) <= 2:
+                block.close()
+                del cls._attached_blocks[name]
+
+    @staticmethod
+    def _untrack(block):
+        """
+        The blocks are tracked by the shared memory manager, which unlinks them when it shuts down.
+        They must not be tracked by the processes using them too, otherwise they are unlinked as soon as one of them exits
+        :param block: The shared memory block
+        """
+        resource_tracker.unregister(block._name, "shared_memory")
+
+
+class CacheManager(SharedMemoryManager, SyncManager):
+    """
+    The manager of the objects shared by the processes using a cache.
+    Besides the objects provided by a SyncManager, it tracks the shared memory blocks holding the large binary results.
+    This way, their tracking doesn't need a server process of its own, which would be started even if no result is
+    ever stored in shared memory. It can't be started on demand, as the processes of a pool can't have children
+    """
+    def release_segment(self, segment_name):
+        """
+        Unlinks a shared memory block tracked by the manager
+        :param segment_name: The name of the block
+        """
+        with self._Client(self._address, authkey=self._authkey) as conn:
+            dispatch(conn, None, "release_segment", (segment_name,))
+
+    def list_segments(self):
+        """
+        :return: The names of the shared memory blocks tracked by the manager
+        """
+        with self._Client(self._address, authkey=self._authkey) as conn:
+            return dispatch(conn, None, "list_segments")
@@ -1,6 +1,10 @@
 from funcache import FileCache, MemoryCache
 from multiprocessing import Pool, cpu_count, Manager
+import tempfile
+import shutil
+import pickle
 import time
+import os
 
 
 @FileCache()
@@ -15,6 +19,44 @@ def test_file(x):
     return x**3
 
 
+@MemoryCache()
+def test_string(s):
+    return s.upper()
+
+
+digest_calls = []
+
+
+@MemoryCache(hash_args=True)
+def test_digest(*values):
+    digest_calls.append(values)
+    return len(values)
+
+
+expiring_calls = []
+
+
+@FileCache(ttl=0.2, max_size=3)
+def test_expiring(x):
+    expiring_calls.append(x)
+    return -x
+
+
+@MemoryCache(cache_size=2)
+def test_large(x):
+    return bytes([x]) * (1 << 17)
+
+
+@MemoryCache()
+def test_local(x):
+    return x
+
+
+@FileCache(ttl=0.5)
+def test_timestamped(x):
+    return time.time()
+
+
 @FileCache()
 def nested_multiprocessing_cache():
     pool_size = cpu_count()
@@ -22,6 +64,20 @@ def nested_multiprocessing_cache():
     MemoryCache.enable_multiprocessing(pool, pool_size)
     FileCache.enable_multiprocessing(pool, pool_size)
     pool.map(compute, values)
+    # The large binary results are stored in shared memory blocks, which are freed when the results are evicted
+    assert all(pool.map(check_large, range(10)))
+    segments_count = len(MemoryCache._manager.list_segments())
+    assert 0 < segments_count <= 2 and segments_count == len(MemoryCache._cache["test_large"])
+    # The results computed by the workers are read from their blocks by the other processes
+    assert all(check_large(x) for (x,) in MemoryCache._cache["test_large"].keys())
+    # Once retrieved, the results are served by the local caches of the processes, without accessing the shared one
+    assert all(pool.map(check_local, range(10)))
+    # The results expire in all the processes, even when they are in their local caches
+    keys = list(range(4)) * pool_size
+    first_results = pool.map(timestamped, keys)
+    assert pool.map(timestamped, keys) == first_results
+    time.sleep(0.6)
+    assert min(pool.map(timestamped, keys)) > max(first_results)
     pool.close()
     pool.join()
     return 3
@@ -31,7 +87,60 @@ def compute(x):
     return test_file(x) + test_memory(x)
 
 
+def check_local(x):
+    test_local(x)
+    MemoryCache._cache["test_local"][(x,)] = -x
+    return test_local(x) == x
+
+
+def timestamped(x):
+    return test_timestamped(x)
+
+
+def check_large(x):
+    result = test_large(x)
+    return len(result) == 1 << 17 and result[0] == x
+
+
 if __name__ == "__main__":
+    # The cache files are written in a temporary folder, removed at the end
+    cache_root = tempfile.mkdtemp()
+    FileCache.init(default_cache_root=cache_root + os.sep)
+    # Strings are used as they are in the args keys, rather than being walked through
+    assert test_string("abc") == "ABC"
+    assert test_string("abc") == "ABC"
+    assert ("abc",) in MemoryCache._cache["test_string"]
+    # Structured arguments are identified by a digest, so equal ones share the same entry
+    assert test_digest([1, 2], {"a": 1}) == 2
+    assert test_digest([1, 2], {"a": 1}) == 2
+    assert len(digest_calls) == 1 and len(MemoryCache._cache["test_digest"]) == 1
+    # Scalar arguments are kept as they are
+    assert test_digest(1, "a") == 2 and (1, "a") in MemoryCache._cache["test_digest"]
+    # Only the 3 most recently computed results are kept, & they are computed again once expired
+    for x in [1, 2, 3, 4, 2]:
+        assert test_expiring(x) == -x
+    assert expiring_calls == [1, 2, 3, 4]
+    assert list(FileCache._cache["test_expiring"]) == [(2,), (3,), (4,)]
+    time.sleep(0.3)
+    assert test_expiring(3) == -3 and expiring_calls == [1, 2, 3, 4, 3]
+    # The cache files written before the timestamps were introduced only contain a dictionary of results
+    results, timestamps, records_count = FileCache.read_cache_file("resources/database/test_file.pkl")
+    assert results[(2,)] == 8 and timestamps.keys() == results.keys() and records_count == len(results)
+    # The cache files are snapshots followed by the records of the results computed since then
+    log_path = os.path.join(cache_root, "test_log.pkl")
+    FileCache.write_cache_file(log_path, {(1,): 1, (2,): 4}, {(1,): 1.0, (2,): 2.0})
+    with open(log_path, "ab") as f:
+        f.write(pickle.dumps(((3,), 9, 3.0)))
+        f.write(pickle.dumps(((1,), -1, 4.0)))
+    results, timestamps, records_count = FileCache.read_cache_file(log_path)
+    assert results == {(2,): 4, (3,): 9, (1,): -1} and list(timestamps.values()) == [2.0, 3.0, 4.0]
+    assert records_count == 4
+    # A truncated last record is removed from the file, so that the next records are appended after the valid ones
+    valid_size = os.path.getsize(log_path)
+    with open(log_path, "ab") as f:
+        f.write(pickle.dumps(((4,), 16, 5.0))[:-2])
+    assert FileCache.read_cache_file(log_path)[0] == results
+    assert os.path.getsize(log_path) == valid_size
     begin_time = time.time()
     values = list(range(10)) * 100
     use_pool = True
@@ -44,5 +153,7 @@ if __name__ == "__main__":
             compute(i)
     elapsed_time = time.time() - begin_time
     print(elapsed_time)
-    FileCache._manager.close()
-    MemoryCache._manager.close()
+    if use_pool:
+        FileCache._manager.shutdown()
+        MemoryCache._manager.shutdown()
+    shutil.rmtree(cache_root)